@@ -0,0 +1,275 @@
+"""
+Shared WebSocket proxy core for the GANZA AI proxy servers.
+
+Both server.py (Vertex AI) and server_gemini_api.py (API key) forward frames
+between the browser client and the Gemini Live API the same way; only the
+upstream URL, headers and the setup-message rewrite differ. Those are passed
+in, so every proxy optimization lives in one place.
+"""
+
+import asyncio
+import contextlib
+import logging
+import queue
+import ssl
+import sys
+from dataclasses import dataclass
+from http import HTTPStatus
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+
+import certifi
+from websockets.asyncio.client import connect
+from websockets.asyncio.connection import Connection
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+
+# A frame transform takes the raw frame and returns the frame to forward
+FrameTransform = Callable[[Union[str, bytes]], Union[str, bytes]]
+
+logger = logging.getLogger(__name__)
+
+# SSL context with certifi certificates, shared by every upstream connection
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+
+@dataclass(slots=True)
+class ProxyState:
+    """Per-connection proxy state, shared by both directions of one proxy."""
+
+    # Frame payload sizes: len() of each frame, i.e. bytes for binary frames and
+    # characters for text frames (not encoded to count bytes on the hot path)
+    chars_or_bytes_in: int = 0  # client -> server
+    chars_or_bytes_out: int = 0  # server -> client
+
+
+class ConnectionLimiter:
+    """
+    Caps the number of in-flight proxies.
+
+    Extra clients wait up to queue_timeout for a free slot, and at most
+    max_connections may wait, so open client sockets stay bounded at roughly
+    twice max_connections.
+    """
+
+    def __init__(self, max_connections: int, queue_timeout: float) -> None:
+        self.max_connections = max_connections
+        self.queue_timeout = queue_timeout
+        self._sem = asyncio.Semaphore(max_connections)
+        self._active = 0
+        self._waiting = 0
+
+    def process_request(self, connection: ServerConnection, request):
+        """
+        Refuses the WebSocket handshake with 503 once the wait queue is full.
+
+        Runs before the upgrade, so excess clients never hold an open WebSocket.
+        """
+        if self._waiting >= self.max_connections:
+            logger.warning("⛔ Connection queue full, rejecting client")
+            return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Server busy, try again later\n")
+        return None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, websocket: ServerConnection) -> AsyncIterator[bool]:
+        """
+        Holds a proxy slot for the duration of the block.
+
+        Yields True once a slot is held. If none frees up within queue_timeout,
+        closes the websocket with 1013 "Try again later" and yields False.
+        """
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⏳ No free proxy slot, asking the client to try again later")
+            try:
+                await websocket.close(code=1013, reason="Try again later")
+            except ConnectionClosed:
+                pass
+            yield False
+            return
+        finally:
+            self._waiting -= 1
+
+        self._active += 1
+        logger.debug(f"   Active connections: {self._active}/{self.max_connections}")
+        try:
+            yield True
+        finally:
+            self._active -= 1
+            self._sem.release()
+
+
+def serve_proxy(
+    handler: Callable[[ServerConnection], Awaitable[None]],
+    port: int,
+    limiter: ConnectionLimiter,
+) -> serve:
+    """
+    Creates the client-facing WebSocket server; use it as an async context manager.
+
+    Args:
+        handler: Coroutine run for each client connection.
+        port: Port to listen on, on all interfaces.
+        limiter: Rejects handshakes once its wait queue is full.
+    """
+    # permessage-deflate is disabled on both legs: frames are mostly base64
+    # audio, which barely compresses but costs CPU and latency to deflate.
+    return serve(
+        handler,
+        "0.0.0.0",
+        port,
+        compression=None,
+        process_request=limiter.process_request,
+    )
+
+
+def setup_logging(debug: bool = False) -> QueueListener:
+    """
+    Routes log records through a queue so the event loop never blocks on stdout.
+
+    Returns the started QueueListener; stop it on shutdown to flush pending records.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    # Only let the websockets library's warnings through, not its per-connection
+    # info lines or per-frame debug logs
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+
+async def proxy_task(
+    source_websocket: Connection,
+    destination_websocket: Connection,
+    state: Optional[ProxyState],
+    is_server: bool,
+    transform: Optional[FrameTransform] = None,
+) -> None:
+    """
+    Forwards messages from source_websocket to destination_websocket.
+
+    Args:
+        source_websocket: The WebSocket connection to receive messages from.
+        destination_websocket: The WebSocket connection to send messages to.
+        state: The per-connection state shared with the opposite direction, or
+            None to skip counting frame sizes.
+        is_server: True if source is server side, False otherwise.
+        transform: Optional one-shot rewrite applied to the first frame only.
+    """
+    direction = 'server' if is_server else 'client'
+    # The Live API sends its JSON responses as binary frames, but the browser
+    # client only handles text (it JSON.parse()s messageEvent.data), so server
+    # frames are re-sent as text without decoding them; client frames keep their type
+    send_as_text = True if is_server else None
+    # Sizes are summed locally and stored on state once the direction ends
+    count_sizes = state is not None
+    size = 0
+    try:
+        async for message in source_websocket:
+            try:
+                if count_sizes:
+                    size += len(message)
+
+                # Only the first frame (the setup message on the client side) may
+                # need rewriting; every later frame is passed through as-is
+                if transform is not None:
+                    rewrite, transform = transform, None
+                    message = rewrite(message)
+
+                # Frames are never parsed; debug output logs the raw payload, so
+                # it cannot fail and change what gets forwarded
+                if logger.isEnabledFor(logging.DEBUG):
+                    if isinstance(message, bytes):
+                        logger.debug(f"Proxying from {direction}: {message.decode(errors='replace')}")
+                    else:
+                        logger.debug(f"Proxying from {direction}: {message}")
+
+                # Frames are sent one by one: each Live API message must stay its
+                # own WebSocket message, and send() already writes straight to
+                # the transport without waiting for a drain below write_limit,
+                # so there is nothing to coalesce
+                await destination_websocket.send(message, text=send_as_text)
+            except Exception as e:
+                logger.error(f"Error processing message: {e}")
+    except ConnectionClosed as e:
+        logger.info(
+            f"{'Server' if is_server else 'Client'} connection closed: {e.code} - {e.reason}"
+        )
+    except Exception as e:
+        logger.error(f"Unexpected error in proxy_task: {e}")
+    finally:
+        if count_sizes:
+            if is_server:
+                state.chars_or_bytes_out = size
+            else:
+                state.chars_or_bytes_in = size
+        await destination_websocket.close()
+
+
+async def run_bidi_proxy(
+    client_websocket: ServerConnection,
+    upstream_url: str,
+    *,
+    headers: dict,
+    transform_client: Optional[FrameTransform] = None,
+    transform_server: Optional[FrameTransform] = None,
+    ssl_context: ssl.SSLContext = SSL_CONTEXT,
+    compression: Optional[str] = None,
+) -> None:
+    """
+    Establishes a WebSocket connection to the Gemini server and creates bidirectional proxy.
+
+    Args:
+        client_websocket: The WebSocket connection of the client.
+        upstream_url: The url of the service to connect to.
+        headers: Extra HTTP headers for the upstream handshake.
+        transform_client: One-shot rewrite for the first client -> server frame.
+        transform_server: One-shot rewrite for the first server -> client frame.
+        ssl_context: SSL context for the upstream connection.
+        compression: Upstream permessage-deflate setting; None disables it.
+    """
+    try:
+        async with connect(
+            upstream_url,
+            additional_headers=headers,
+            ssl=ssl_context,
+            compression=compression,
+        ) as server_websocket:
+            logger.info(f"✅ Connected to Gemini API")
+
+            # Create bidirectional proxy tasks
+            # Each proxy_task closes its destination when its source ends, which
+            # in turn ends the opposite direction, so the group exits once both
+            # sides are closed
+            # Frame sizes only feed the teardown debug log, so they are only
+            # counted when DEBUG is on at proxy start
+            state = ProxyState() if logger.isEnabledFor(logging.DEBUG) else None
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(proxy_task(client_websocket, server_websocket, state, is_server=False, transform=transform_client))
+                tg.create_task(proxy_task(server_websocket, client_websocket, state, is_server=True, transform=transform_server))
+            if state is not None:
+                logger.debug(
+                    f"Proxy closed: {state.chars_or_bytes_in} in, {state.chars_or_bytes_out} out "
+                    f"(characters for text frames, bytes for binary)"
+                )
+
+    except ConnectionClosed as e:
+        logger.warning(f"Server connection closed unexpectedly: {e.code} - {e.reason}")
+        try:
+            await client_websocket.close(code=e.code, reason=e.reason)
+        except ConnectionClosed:
+            pass
+    except Exception as e:
+        logger.error(f"Failed to connect to Gemini API: {e}")
+        try:
+            await client_websocket.close(code=1008, reason="Upstream connection failed")
+        except ConnectionClosed:
+            pass
@@ -8,16 +8,23 @@ handling authentication automatically using default credentials.
 """
 
 import asyncio
-import websockets
-import json
-import ssl
-import certifi
+import orjson
+import logging
 import os
+import threading
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from websockets.legacy.server import WebSocketServerProtocol
-from websockets.legacy.protocol import WebSocketCommonProtocol
+from websockets.asyncio.server import ServerConnection
 from websockets.exceptions import ConnectionClosed
 
+from proxy_core import ConnectionLimiter, run_bidi_proxy, serve_proxy, setup_logging
+
+# uvloop is optional (not available on Windows); fall back to the stock loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Load environment variables
 from dotenv import load_dotenv
 
@@ -25,105 +32,115 @@ from dotenv import load_dotenv
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
-# Authentication imports
-import google.auth
-from google.auth.transport.requests import Request
-
 # Configuration from environment variables
 DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
 WS_PORT = int(os.getenv('WS_PORT', '8080'))
 GCP_PROJECT_ID = os.getenv('GCP_PROJECT_ID', '')
 GCP_REGION = os.getenv('GCP_REGION', 'us-central1')
 DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'gemini-live-2.5-flash-native-audio')
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', '256'))
+CONN_QUEUE_TIMEOUT = float(os.getenv('CONN_QUEUE_TIMEOUT', '10'))
 # Get credentials path, strip whitespace, use None if empty
 _creds_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', '').strip()
 GOOGLE_APPLICATION_CREDENTIALS = _creds_path if _creds_path else None
 
+logger = logging.getLogger(__name__)
+
+_limiter = ConnectionLimiter(MAX_CONNECTIONS, CONN_QUEUE_TIMEOUT)
+
+# Access tokens are cached and only refreshed when this close to expiry
+TOKEN_REFRESH_MARGIN = timedelta(seconds=60)
+_creds_cache = None
+_creds_project = None
+_creds_lock = threading.Lock()
+
+
+def _token_is_fresh(creds):
+    """Returns True if the cached credentials can be used without a refresh."""
+    if not creds.valid:
+        return False
+    if creds.expiry is None:
+        return True
+    now = datetime.now(timezone.utc).replace(tzinfo=None)  # google.auth expiry is naive UTC
+    return creds.expiry - now > TOKEN_REFRESH_MARGIN
+
+
+def _load_credentials():
+    """Loads credentials from the service account file or ADC."""
+    # Use service account if path provided, otherwise use ADC
+    if GOOGLE_APPLICATION_CREDENTIALS:
+        # Verify the file exists
+        if not os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
+            raise FileNotFoundError(f"Service account file not found: {GOOGLE_APPLICATION_CREDENTIALS}")
+        # Set environment variable for google.auth to use
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = GOOGLE_APPLICATION_CREDENTIALS
+        logger.info(f"🔑 Using service account: {GOOGLE_APPLICATION_CREDENTIALS}")
+    else:
+        # Ensure GOOGLE_APPLICATION_CREDENTIALS is not set to empty string (use ADC)
+        # If it's set to empty string in .env, it will be in os.environ as empty string
+        # We need to remove it so google.auth.default() uses ADC instead
+        if 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
+            env_creds = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', '').strip()
+            if not env_creds:
+                # It's empty, remove it to use ADC
+                del os.environ['GOOGLE_APPLICATION_CREDENTIALS']
+        logger.info("🔑 Using Application Default Credentials (ADC)")
+
+    # Imported lazily so importing this module doesn't load the google.auth stack
+    import google.auth
+
+    # Get credentials - this will use ADC if GOOGLE_APPLICATION_CREDENTIALS is not set
+    creds, project = google.auth.default()
+
+    # Verify project matches if specified
+    if GCP_PROJECT_ID and project and project != GCP_PROJECT_ID:
+        logger.warning(f"⚠️ Warning: Credentials project ({project}) doesn't match GCP_PROJECT_ID ({GCP_PROJECT_ID})")
+
+    return creds, project
+
 
 def generate_access_token():
-    """Retrieves an access token using credentials from environment."""
-    try:
-        # Use service account if path provided, otherwise use ADC
-        if GOOGLE_APPLICATION_CREDENTIALS:
-            # Verify the file exists
-            if not os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
-                raise FileNotFoundError(f"Service account file not found: {GOOGLE_APPLICATION_CREDENTIALS}")
-            # Set environment variable for google.auth to use
-            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = GOOGLE_APPLICATION_CREDENTIALS
-            print(f"🔑 Using service account: {GOOGLE_APPLICATION_CREDENTIALS}")
-        else:
-            # Ensure GOOGLE_APPLICATION_CREDENTIALS is not set to empty string (use ADC)
-            # If it's set to empty string in .env, it will be in os.environ as empty string
-            # We need to remove it so google.auth.default() uses ADC instead
-            if 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
-                env_creds = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', '').strip()
-                if not env_creds:
-                    # It's empty, remove it to use ADC
-                    del os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-            print("🔑 Using Application Default Credentials (ADC)")
-        
-        # Get credentials - this will use ADC if GOOGLE_APPLICATION_CREDENTIALS is not set
-        creds, project = google.auth.default()
-        
-        # Verify project matches if specified
-        if GCP_PROJECT_ID and project and project != GCP_PROJECT_ID:
-            print(f"⚠️ Warning: Credentials project ({project}) doesn't match GCP_PROJECT_ID ({GCP_PROJECT_ID})")
-        
-        if not creds.valid:
-            print("🔄 Refreshing access token...")
-            creds.refresh(Request())
-        
-        print(f"✅ Access token generated for project: {project or GCP_PROJECT_ID or 'default'}")
-        return creds.token
-    except FileNotFoundError as e:
-        print(f"❌ Error: {e}")
-        print(f"   Make sure the service account file path is correct in .env")
-        return None
-    except Exception as e:
-        print(f"❌ Error generating access token: {e}")
-        if GOOGLE_APPLICATION_CREDENTIALS:
-            print(f"   Check if service account file exists: {GOOGLE_APPLICATION_CREDENTIALS}")
-            print(f"   Make sure the file path is correct and the service account has roles/aiplatform.user role")
-        else:
-            print("   Make sure you're logged in with: gcloud auth application-default login")
-            print("   Run: gcloud auth application-default login --scopes=https://www.googleapis.com/auth/cloud-platform")
-        return None
-
-
-async def proxy_task(
-    source_websocket: WebSocketCommonProtocol,
-    destination_websocket: WebSocketCommonProtocol,
-    is_server: bool,
-) -> None:
     """
-    Forwards messages from source_websocket to destination_websocket.
+    Retrieves an access token using credentials from environment.
 
-    Args:
-        source_websocket: The WebSocket connection to receive messages from.
-        destination_websocket: The WebSocket connection to send messages to.
-        is_server: True if source is server side, False otherwise.
+    Credentials are loaded once and cached; their token is reused until it is
+    within TOKEN_REFRESH_MARGIN of expiry, then refreshed in place.
     """
-    try:
-        async for message in source_websocket:
-            try:
-                data = json.loads(message)
-                if DEBUG:
-                    print(f"Proxying from {'server' if is_server else 'client'}: {data}")
-                await destination_websocket.send(json.dumps(data))
-            except Exception as e:
-                print(f"Error processing message: {e}")
-    except ConnectionClosed as e:
-        print(
-            f"{'Server' if is_server else 'Client'} connection closed: {e.code} - {e.reason}"
-        )
-    except Exception as e:
-        print(f"Unexpected error in proxy_task: {e}")
-    finally:
-        await destination_websocket.close()
+    global _creds_cache, _creds_project
+    # Runs in worker threads (see handle_websocket_client); serialize so
+    # concurrent connections don't race to load or refresh
+    with _creds_lock:
+        try:
+            if _creds_cache is None:
+                _creds_cache, _creds_project = _load_credentials()
+            elif _token_is_fresh(_creds_cache):
+                return _creds_cache.token
+
+            if not _token_is_fresh(_creds_cache):
+                from google.auth.transport.requests import Request
+
+                logger.info("🔄 Refreshing access token...")
+                _creds_cache.refresh(Request())
+
+            logger.info(f"✅ Access token generated for project: {_creds_project or GCP_PROJECT_ID or 'default'}")
+            return _creds_cache.token
+        except FileNotFoundError as e:
+            logger.error(f"❌ Error: {e}")
+            logger.error(f"   Make sure the service account file path is correct in .env")
+            return None
+        except Exception as e:
+            logger.error(f"❌ Error generating access token: {e}")
+            if GOOGLE_APPLICATION_CREDENTIALS:
+                logger.error(f"   Check if service account file exists: {GOOGLE_APPLICATION_CREDENTIALS}")
+                logger.error(f"   Make sure the file path is correct and the service account has roles/aiplatform.user role")
+            else:
+                logger.error("   Make sure you're logged in with: gcloud auth application-default login")
+                logger.error("   Run: gcloud auth application-default login --scopes=https://www.googleapis.com/auth/cloud-platform")
+            return None
 
 
 async def create_proxy(
-    client_websocket: WebSocketCommonProtocol, bearer_token: str, service_url: str
+    client_websocket: ServerConnection, bearer_token: str, service_url: str
 ) -> None:
     """
     Establishes a WebSocket connection to the Gemini server and creates bidirectional proxy.
@@ -138,65 +155,17 @@ async def create_proxy(
         "Authorization": f"Bearer {bearer_token}",
     }
 
-    # Create SSL context with certifi certificates
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    logger.info(f"Connecting to Gemini API...")
+    logger.debug(f"Service URL: {service_url}")
 
-    print(f"Connecting to Gemini API...")
-    if DEBUG:
-        print(f"Service URL: {service_url}")
+    await run_bidi_proxy(
+        client_websocket,
+        service_url,
+        headers=headers,
+    )
 
-    try:
-        async with websockets.connect(
-            service_url,
-            additional_headers=headers,
-            ssl=ssl_context
-        ) as server_websocket:
-            print(f"✅ Connected to Gemini API")
-
-            # Create bidirectional proxy tasks
-            client_to_server_task = asyncio.create_task(
-                proxy_task(client_websocket, server_websocket, is_server=False)
-            )
-            server_to_client_task = asyncio.create_task(
-                proxy_task(server_websocket, client_websocket, is_server=True)
-            )
 
-            # Wait for either task to complete
-            done, pending = await asyncio.wait(
-                [client_to_server_task, server_to_client_task],
-                return_when=asyncio.FIRST_COMPLETED,
-            )
-
-            # Cancel the remaining task
-            for task in pending:
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-
-            # Close connections
-            try:
-                await server_websocket.close()
-            except:
-                pass
-
-            try:
-                await client_websocket.close()
-            except:
-                pass
-
-    except ConnectionClosed as e:
-        print(f"Server connection closed unexpectedly: {e.code} - {e.reason}")
-        if not client_websocket.closed:
-            await client_websocket.close(code=e.code, reason=e.reason)
-    except Exception as e:
-        print(f"Failed to connect to Gemini API: {e}")
-        if not client_websocket.closed:
-            await client_websocket.close(code=1008, reason="Upstream connection failed")
-
-
-async def handle_websocket_client(client_websocket: WebSocketServerProtocol) -> None:
+async def handle_websocket_client(client_websocket: ServerConnection) -> None:
     """
     Handles a new WebSocket client connection.
 
@@ -206,54 +175,61 @@ async def handle_websocket_client(client_websocket: WebSocketServerProtocol) ->
     Args:
         client_websocket: The WebSocket connection of the client.
     """
-    print("🔌 New WebSocket client connection...")
-    try:
-        # Wait for the first message from the client
-        service_setup_message = await asyncio.wait_for(
-            client_websocket.recv(), timeout=10.0
-        )
-        service_setup_message_data = json.loads(service_setup_message)
-
-        bearer_token = service_setup_message_data.get("bearer_token")
-        service_url = service_setup_message_data.get("service_url")
-
-        # If no bearer token provided, generate one using default credentials
-        if not bearer_token:
-            print("🔑 Generating access token using default credentials...")
-            bearer_token = generate_access_token()
+    logger.info("🔌 New WebSocket client connection...")
+    async with _limiter.slot(client_websocket) as acquired:
+        if not acquired:
+            return
+        try:
+            # Wait for the first message from the client
+            service_setup_message = await asyncio.wait_for(
+                client_websocket.recv(), timeout=10.0
+            )
+            service_setup_message_data = orjson.loads(service_setup_message)
+
+            bearer_token = service_setup_message_data.get("bearer_token")
+            service_url = service_setup_message_data.get("service_url")
+
+            # If no bearer token provided, generate one using default credentials
             if not bearer_token:
-                print("❌ Failed to generate access token")
+                logger.info("🔑 Generating access token using default credentials...")
+                # Off the event loop: a token refresh is a blocking HTTP call
+                # that would otherwise stall every live proxy
+                bearer_token = await asyncio.to_thread(generate_access_token)
+                if not bearer_token:
+                    logger.error("❌ Failed to generate access token")
+                    await client_websocket.close(
+                        code=1008, reason="Authentication failed"
+                    )
+                    return
+                logger.info("✅ Access token generated")
+
+            if not service_url:
+                logger.error("❌ Error: Service URL is missing")
                 await client_websocket.close(
-                    code=1008, reason="Authentication failed"
+                    code=1008, reason="Service URL is required"
                 )
                 return
-            print("✅ Access token generated")
-
-        if not service_url:
-            print("❌ Error: Service URL is missing")
-            await client_websocket.close(
-                code=1008, reason="Service URL is required"
-            )
-            return
 
-        await create_proxy(client_websocket, bearer_token, service_url)
+            await create_proxy(client_websocket, bearer_token, service_url)
 
-    except asyncio.TimeoutError:
-        print("⏱️ Timeout waiting for the first message from the client")
-        await client_websocket.close(code=1008, reason="Timeout")
-    except json.JSONDecodeError as e:
-        print(f"❌ Invalid JSON in first message: {e}")
-        await client_websocket.close(code=1008, reason="Invalid JSON")
-    except Exception as e:
-        print(f"❌ Error handling client: {e}")
-        if not client_websocket.closed:
-            await client_websocket.close(code=1011, reason="Internal error")
+        except asyncio.TimeoutError:
+            logger.warning("⏱️ Timeout waiting for the first message from the client")
+            await client_websocket.close(code=1008, reason="Timeout")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"❌ Invalid JSON in first message: {e}")
+            await client_websocket.close(code=1008, reason="Invalid JSON")
+        except Exception as e:
+            logger.exception(f"❌ Error handling client: {e}")
+            try:
+                await client_websocket.close(code=1011, reason="Internal error")
+            except ConnectionClosed:
+                pass
 
 
 async def start_websocket_server():
     """Start the WebSocket proxy server."""
-    async with websockets.serve(handle_websocket_client, "0.0.0.0", WS_PORT):
-        print(f"🔌 WebSocket proxy running on ws://localhost:{WS_PORT}")
+    async with serve_proxy(handle_websocket_client, WS_PORT, _limiter):
+        logger.info(f"🔌 WebSocket proxy running on ws://localhost:{WS_PORT}")
         # Run forever
         await asyncio.Future()
 
@@ -264,18 +240,18 @@ async def main():
     """
     # Validate configuration
     if not GCP_PROJECT_ID:
-        print("⚠️ Warning: GCP_PROJECT_ID not set in .env file")
-        print("   The frontend will need to provide project ID in the connection message")
+        logger.warning("⚠️ Warning: GCP_PROJECT_ID not set in .env file")
+        logger.warning("   The frontend will need to provide project ID in the connection message")
     
     # Test authentication on startup
-    print("🔍 Testing authentication...")
+    logger.info("🔍 Testing authentication...")
     token = generate_access_token()
     if not token:
-        print("❌ Authentication test failed. Please check your credentials.")
-        print("   See .env.example for configuration options")
+        logger.error("❌ Authentication test failed. Please check your credentials.")
+        logger.error("   See .env.example for configuration options")
         return
     
-    print(f"""
+    logger.info(f"""
 ╔════════════════════════════════════════════════════════════╗
 ║     Gemini Live API Proxy Server (Vertex AI)              ║
 ╠════════════════════════════════════════════════════════════╣
@@ -295,7 +271,14 @@ async def main():
 
 
 if __name__ == "__main__":
+    log_listener = setup_logging(DEBUG)
+    # Pass uvloop as the loop factory instead of installing its event loop
+    # policy, which is deprecated as of Python 3.14
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Servers stopped")
\ No newline at end of file
+        logger.info("\n👋 Servers stopped")
+    finally:
+        log_listener.stop()
\ No newline at end of file
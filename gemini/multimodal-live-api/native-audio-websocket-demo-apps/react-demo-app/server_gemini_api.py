@@ -7,16 +7,24 @@ This is a SEPARATE server file. If this fails, use server.py for alternative aut
 """
 
 import asyncio
-import websockets
+import functools
 import json
-import ssl
-import certifi
+import orjson
+import logging
 import os
 from pathlib import Path
-from websockets.legacy.server import WebSocketServerProtocol
-from websockets.legacy.protocol import WebSocketCommonProtocol
+from types import MappingProxyType
+from websockets.asyncio.server import ServerConnection
 from websockets.exceptions import ConnectionClosed
 
+from proxy_core import ConnectionLimiter, run_bidi_proxy, serve_proxy, setup_logging
+
+# uvloop is optional (not available on Windows); fall back to the stock loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Load environment variables
 from dotenv import load_dotenv
 
@@ -28,7 +36,35 @@ load_dotenv(dotenv_path=env_path)
 DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
 WS_PORT = int(os.getenv('WS_PORT', '8080'))
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
+# Gemini API endpoint, fixed for the process lifetime (frontend's service_url is ignored)
+# Correct endpoint format: v1beta with dot notation (not slash)
+GEMINI_WS_URL = (
+    f"wss://generativelanguage.googleapis.com/ws/google.ai.generativelanguage.v1beta.GenerativeService.BidiGenerateContent?key={GEMINI_API_KEY}"
+    if GEMINI_API_KEY else None
+)
 DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'gemini-2.5-flash-native-audio-preview-12-2025')
+MAX_CONNECTIONS = int(os.getenv('MAX_CONNECTIONS', '256'))
+CONN_QUEUE_TIMEOUT = float(os.getenv('CONN_QUEUE_TIMEOUT', '10'))
+
+# Model name mapping: Vertex AI -> Gemini API (built once, read-only)
+MODEL_MAPPING = MappingProxyType({
+    # Native Audio Models
+    "gemini-live-2.5-flash-native-audio": "gemini-2.5-flash-native-audio-preview-12-2025",
+    "gemini-live-2.5-flash-preview-native-audio-09-2025": "gemini-2.5-flash-native-audio-preview-12-2025",
+
+    # Standard Models
+    "gemini-2.0-flash-exp": "gemini-2.0-flash-exp",
+    "gemini-1.5-pro": "gemini-1.5-pro",
+    "gemini-1.5-flash": "gemini-1.5-flash",
+})
+
+# Vertex AI-specific fields that the Gemini API does not support
+UNSUPPORTED_SETUP_FIELDS = ("proactivity",)
+UNSUPPORTED_GEN_CONFIG_FIELDS = ("enable_affective_dialog",)
+
+logger = logging.getLogger(__name__)
+
+_limiter = ConnectionLimiter(MAX_CONNECTIONS, CONN_QUEUE_TIMEOUT)
 
 
 def map_vertex_ai_to_gemini_api_model(vertex_model_name):
@@ -38,23 +74,10 @@ def map_vertex_ai_to_gemini_api_model(vertex_model_name):
     Vertex AI uses different model names than Gemini API.
     This function converts Vertex AI model names to Gemini API equivalents.
     """
-    # Model name mapping: Vertex AI -> Gemini API
-    model_mapping = {
-        # Native Audio Models
-        "gemini-live-2.5-flash-native-audio": "gemini-2.5-flash-native-audio-preview-12-2025",
-        "gemini-live-2.5-flash-preview-native-audio-09-2025": "gemini-2.5-flash-native-audio-preview-12-2025",
-        
-        # Standard Models
-        "gemini-2.0-flash-exp": "gemini-2.0-flash-exp",
-        "gemini-1.5-pro": "gemini-1.5-pro",
-        "gemini-1.5-flash": "gemini-1.5-flash",
-    }
-    
     # Check if we have a mapping
-    if vertex_model_name in model_mapping:
-        mapped_name = model_mapping[vertex_model_name]
-        if DEBUG:
-            print(f"Mapped Vertex AI model: {vertex_model_name} -> {mapped_name}")
+    mapped_name = MODEL_MAPPING.get(vertex_model_name)
+    if mapped_name is not None:
+        logger.debug(f"Mapped Vertex AI model: {vertex_model_name} -> {mapped_name}")
         return mapped_name
     
     # If no mapping found, check if it's already a Gemini API model name
@@ -64,17 +87,19 @@ def map_vertex_ai_to_gemini_api_model(vertex_model_name):
         return vertex_model_name
     
     # Unknown Vertex AI model - use default
-    if DEBUG:
-        print(f"Unknown Vertex AI model: {vertex_model_name}, using default: {DEFAULT_MODEL}")
+    logger.debug(f"Unknown Vertex AI model: {vertex_model_name}, using default: {DEFAULT_MODEL}")
     return DEFAULT_MODEL
 
 
+@functools.lru_cache(maxsize=64)
 def extract_model_name(model_uri):
     """
     Extract model name from Vertex AI format and convert to Gemini API format.
     
     Vertex AI format: "projects/{project}/locations/{region}/publishers/google/models/{model}"
     Gemini API format: "models/{model}" (REQUIRED - Gemini API demands "models/" prefix)
+
+    Results are cached: only a handful of distinct model URIs ever show up.
     """
     if not model_uri:
         return f"models/{DEFAULT_MODEL}"
@@ -98,83 +123,62 @@ def extract_model_name(model_uri):
     return gemini_api_model
 
 
-async def proxy_task(
-    source_websocket: WebSocketCommonProtocol,
-    destination_websocket: WebSocketCommonProtocol,
-    is_server: bool,
-    transform_setup_message: bool = False,
-) -> None:
+def rewrite_setup(setup):
     """
-    Forwards messages from source_websocket to destination_websocket.
-    Can transform setup messages for Gemini API compatibility.
+    Rewrite a Vertex AI setup message in place for the Gemini API.
 
-    Args:
-        source_websocket: The WebSocket connection to receive messages from.
-        destination_websocket: The WebSocket connection to send messages to.
-        is_server: True if source is server side, False otherwise.
-        transform_setup_message: If True, transform setup messages for Gemini API.
+    Converts the model name and drops Vertex AI-specific fields that the
+    Gemini API rejects, in a single pass over the setup dict.
     """
-    try:
-        async for message in source_websocket:
-            try:
-                data = json.loads(message)
-                
-                # Transform setup message if needed (client -> server)
-                if transform_setup_message and not is_server and "setup" in data:
-                    setup = data["setup"]
-                    
-                    # Extract just model name from Vertex AI format and convert to Gemini API
-                    if "model" in setup:
-                        original_model = setup["model"]
-                        model_name = extract_model_name(original_model)
-                        setup["model"] = model_name
-                        print(f"🔄 Model transformation: {original_model} -> {model_name}")
-                        print(f"✅ Sending to Gemini API with 'models/' prefix (required format)")
-                        if DEBUG:
-                            print(f"   Full setup message: {json.dumps(setup, indent=2)}")
-                    
-                    # Remove unsupported fields for Gemini API
-                    # These fields are Vertex AI-specific and not supported by Gemini API
-                    unsupported_setup_fields = [
-                        "proactivity",  # Not supported by Gemini API
-                    ]
-                    
-                    for field in unsupported_setup_fields:
-                        if field in setup:
-                            del setup[field]
-                            if DEBUG:
-                                print(f"Removed unsupported setup field: {field}")
-                    
-                    # Remove unsupported fields from generation_config
-                    if "generation_config" in setup:
-                        gen_config = setup["generation_config"]
-                        unsupported_gen_config_fields = [
-                            "enable_affective_dialog",  # Not supported by Gemini API
-                        ]
-                        
-                        for field in unsupported_gen_config_fields:
-                            if field in gen_config:
-                                del gen_config[field]
-                                if DEBUG:
-                                    print(f"Removed unsupported generation_config field: {field}")
-                
-                if DEBUG:
-                    print(f"Proxying from {'server' if is_server else 'client'}: {data}")
-                await destination_websocket.send(json.dumps(data))
-            except Exception as e:
-                print(f"Error processing message: {e}")
-    except ConnectionClosed as e:
-        print(
-            f"{'Server' if is_server else 'Client'} connection closed: {e.code} - {e.reason}"
-        )
-    except Exception as e:
-        print(f"Unexpected error in proxy_task: {e}")
-    finally:
-        await destination_websocket.close()
+    # Extract just model name from Vertex AI format and convert to Gemini API
+    if "model" in setup:
+        original_model = setup["model"]
+        model_name = extract_model_name(original_model)
+        setup["model"] = model_name
+        logger.info(f"🔄 Model transformation: {original_model} -> {model_name}")
+        logger.info(f"✅ Sending to Gemini API with 'models/' prefix (required format)")
+
+    # Remove unsupported fields for Gemini API
+    # These fields are Vertex AI-specific and not supported by Gemini API
+    for field in UNSUPPORTED_SETUP_FIELDS:
+        if setup.pop(field, None) is not None:
+            logger.debug(f"Removed unsupported setup field: {field}")
+
+    # Remove unsupported fields from generation_config
+    gen_config = setup.get("generation_config")
+    if gen_config:
+        for field in UNSUPPORTED_GEN_CONFIG_FIELDS:
+            if gen_config.pop(field, None) is not None:
+                logger.debug(f"Removed unsupported generation_config field: {field}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"   Full setup message: {json.dumps(setup, indent=2)}")
+
+
+def _rewrite_setup_parsed(message):
+    """Parses a setup frame, rewrites it with rewrite_setup() and re-serializes it."""
+    data = orjson.loads(message)
+    if "setup" in data:
+        rewrite_setup(data["setup"])
+    return orjson.dumps(data).decode()
+
+
+def rewrite_setup_message(message):
+    """
+    Rewrite a raw client setup frame for the Gemini API.
+
+    Frames without a setup key are passed through untouched; the rest go through
+    rewrite_setup(). Always returns a str so the frame goes upstream as text.
+    """
+    if isinstance(message, bytes):
+        message = message.decode()
+    if '"setup"' not in message:
+        return message
+    return _rewrite_setup_parsed(message)
 
 
 async def create_proxy(
-    client_websocket: WebSocketCommonProtocol, service_url: str
+    client_websocket: ServerConnection, service_url: str
 ) -> None:
     """
     Establishes a WebSocket connection to Gemini API and creates bidirectional proxy.
@@ -188,121 +192,67 @@ async def create_proxy(
         "Content-Type": "application/json",
     }
 
-    # Create SSL context with certifi certificates
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    logger.info(f"Connecting to Gemini API...")
+    logger.debug(f"Service URL: {service_url[:80]}...")  # Don't log full URL with API key
 
-    print(f"Connecting to Gemini API...")
-    if DEBUG:
-        print(f"Service URL: {service_url[:80]}...")  # Don't print full URL with API key
+    # Transform setup messages from client (extract model name)
+    await run_bidi_proxy(
+        client_websocket,
+        service_url,
+        headers=headers,
+        transform_client=rewrite_setup_message,
+    )
 
-    try:
-        async with websockets.connect(
-            service_url,
-            additional_headers=headers,
-            ssl=ssl_context
-        ) as server_websocket:
-            print(f"✅ Connected to Gemini API")
-
-            # Create bidirectional proxy tasks
-            # Transform setup messages from client (extract model name)
-            client_to_server_task = asyncio.create_task(
-                proxy_task(client_websocket, server_websocket, is_server=False, transform_setup_message=True)
-            )
-            server_to_client_task = asyncio.create_task(
-                proxy_task(server_websocket, client_websocket, is_server=True, transform_setup_message=False)
-            )
 
-            # Wait for either task to complete
-            done, pending = await asyncio.wait(
-                [client_to_server_task, server_to_client_task],
-                return_when=asyncio.FIRST_COMPLETED,
-            )
-
-            # Cancel the remaining task
-            for task in pending:
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-
-            # Close connections
-            try:
-                await server_websocket.close()
-            except:
-                pass
-
-            try:
-                await client_websocket.close()
-            except:
-                pass
-
-    except ConnectionClosed as e:
-        print(f"Server connection closed unexpectedly: {e.code} - {e.reason}")
-        try:
-            await client_websocket.close(code=e.code, reason=e.reason)
-        except:
-            pass
-    except Exception as e:
-        print(f"Failed to connect to Gemini API: {e}")
-        try:
-            await client_websocket.close(code=1008, reason="Upstream connection failed")
-        except:
-            pass
-
-
-async def handle_websocket_client(client_websocket: WebSocketServerProtocol) -> None:
+async def handle_websocket_client(client_websocket: ServerConnection) -> None:
     """
     Handles a new WebSocket client connection.
 
     Args:
         client_websocket: The WebSocket connection of the client.
     """
-    print("🔌 New WebSocket client connection...")
-    try:
-        # Wait for the first message from the client
-        service_setup_message = await asyncio.wait_for(
-            client_websocket.recv(), timeout=10.0
-        )
-        service_setup_message_data = json.loads(service_setup_message)
-
-        # ALWAYS use Gemini API URL (ignore frontend's service_url)
-        if not GEMINI_API_KEY:
-            print("❌ Error: GEMINI_API_KEY not set in .env file")
-            await client_websocket.close(
-                code=1008, reason="API key required"
-            )
+    logger.info("🔌 New WebSocket client connection...")
+    async with _limiter.slot(client_websocket) as acquired:
+        if not acquired:
             return
-        
-        # Always build Gemini API endpoint (ignore what frontend sends)
-        # Correct endpoint format: v1beta with dot notation (not slash)
-        service_url = f"wss://generativelanguage.googleapis.com/ws/google.ai.generativelanguage.v1beta.GenerativeService.BidiGenerateContent?key={GEMINI_API_KEY}"
-        print(f"✅ Using Gemini API endpoint (ignoring frontend's service_url)")
-        if DEBUG:
-            print(f"   Endpoint: {service_url[:100]}...")  # Print partial URL for debugging
-
-        await create_proxy(client_websocket, service_url)
-
-    except asyncio.TimeoutError:
-        print("⏱️ Timeout waiting for the first message from the client")
-        await client_websocket.close(code=1008, reason="Timeout")
-    except json.JSONDecodeError as e:
-        print(f"❌ Invalid JSON in first message: {e}")
-        await client_websocket.close(code=1008, reason="Invalid JSON")
-    except Exception as e:
-        print(f"❌ Error handling client: {e}")
-        import traceback
-        traceback.print_exc()
         try:
-            await client_websocket.close(code=1011, reason="Internal error")
-        except:
-            pass
+            # Wait for the first message from the client
+            service_setup_message = await asyncio.wait_for(
+                client_websocket.recv(), timeout=10.0
+            )
+            service_setup_message_data = orjson.loads(service_setup_message)
+
+            # ALWAYS use Gemini API URL (ignore frontend's service_url)
+            if not GEMINI_WS_URL:
+                logger.error("❌ Error: GEMINI_API_KEY not set in .env file")
+                await client_websocket.close(
+                    code=1008, reason="API key required"
+                )
+                return
+    
+            logger.info(f"✅ Using Gemini API endpoint (ignoring frontend's service_url)")
+            logger.debug(f"   Endpoint: {GEMINI_WS_URL[:100]}...")  # Log partial URL for debugging
+
+            await create_proxy(client_websocket, GEMINI_WS_URL)
+
+        except asyncio.TimeoutError:
+            logger.warning("⏱️ Timeout waiting for the first message from the client")
+            await client_websocket.close(code=1008, reason="Timeout")
+        except orjson.JSONDecodeError as e:
+            logger.error(f"❌ Invalid JSON in first message: {e}")
+            await client_websocket.close(code=1008, reason="Invalid JSON")
+        except Exception as e:
+            logger.exception(f"❌ Error handling client: {e}")
+            try:
+                await client_websocket.close(code=1011, reason="Internal error")
+            except ConnectionClosed:
+                pass
 
 
 async def start_websocket_server():
     """Start the WebSocket proxy server."""
-    async with websockets.serve(handle_websocket_client, "0.0.0.0", WS_PORT):
-        print(f"🔌 WebSocket proxy running on ws://localhost:{WS_PORT}")
+    async with serve_proxy(handle_websocket_client, WS_PORT, _limiter):
+        logger.info(f"🔌 WebSocket proxy running on ws://localhost:{WS_PORT}")
         # Run forever
         await asyncio.Future()
 
@@ -313,12 +263,12 @@ async def main():
     """
     # Validate configuration
     if not GEMINI_API_KEY:
-        print("❌ Error: GEMINI_API_KEY not set in .env file")
-        print("   Get your API key from: https://aistudio.google.com/app/apikey")
-        print("   Add to .env: GEMINI_API_KEY=your-api-key-here")
+        logger.error("❌ Error: GEMINI_API_KEY not set in .env file")
+        logger.error("   Get your API key from: https://aistudio.google.com/app/apikey")
+        logger.error("   Add to .env: GEMINI_API_KEY=your-api-key-here")
         return
     
-    print(f"""
+    logger.info(f"""
 ╔════════════════════════════════════════════════════════════╗
 ║     Gemini API Proxy Server (NOT Vertex AI)               ║
 ╠════════════════════════════════════════════════════════════╣
@@ -336,7 +286,14 @@ async def main():
 
 
 if __name__ == "__main__":
+    log_listener = setup_logging(DEBUG)
+    # Pass uvloop as the loop factory instead of installing its event loop
+    # policy, which is deprecated as of Python 3.14
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Server stopped")
+        logger.info("\n👋 Server stopped")
+    finally:
+        log_listener.stop()